@@ -1,5 +1,6 @@
 """命令行接口模块"""
 import click
+import datetime
 import os
 import sys
 import logging
@@ -7,7 +8,9 @@ import pandas as pd
 from pathlib import Path
 from .config import get_dbpath, update_config_dbpath, get_config_path
 from .db import db_sql
-from .cloud import client, get_default_bucket, upload_file2cloud, download_file, query_obj
+from .replica import get_read_dbpath
+from .cloud import (client, get_default_bucket, upload_file2cloud, download_file, query_obj,
+                    list_multipart_uploads, abort_multipart_upload, PARTIAL_SUFFIX)
 
 # 初始化日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -152,7 +155,8 @@ def local2cloud(bucket, local_path, cloud_path):
     if result is not None:
         print('云上路径已存在')
     else:
-        upload_file2cloud(s3, bucket, local_path, cloud_path)
+        # 大文件的传输日志记录在主库中，中断后重新执行会从未完成的分段继续
+        upload_file2cloud(s3, bucket, local_path, cloud_path, dbpath=get_dbpath())
 
 
 @main.command(name="c2l", short_help="cloud file to local")
@@ -177,17 +181,76 @@ def cloud2local(bucket, cloud_path, outpath):
     result = query_obj(s3, bucket, cloud_path)
 
     if result is not None:
-        download_file(s3, bucket, cloud_path, outpath)
+        # 大文件的传输日志记录在主库中，中断后重新执行会从未完成的分段继续
+        download_file(s3, bucket, cloud_path, outpath, dbpath=get_dbpath())
     else:
         logger.error(f'云上文件不存在: {cloud_path}')
         sys.exit(1)
 
 
+@main.command(name="transfers", short_help="list or clean up resumable transfers")
+@click.option('--bucket', '-b',
+              default=None,
+              help='bucket名称，如果不指定则使用配置文件中的默认bucket')
+@click.option('--clean', is_flag=True,
+              help='中止并清理该 bucket 中超过 --hours 小时未更新的传输')
+@click.option('--hours', default=24, type=int, show_default=True,
+              help='超过该小时数未更新的传输视为过期')
+@click.option('--all-uploads', is_flag=True,
+              help='配合 --clean 使用，同时中止 bucket 中不在传输日志里的过期分段上传（可能属于其他用户或工具）')
+def transfers(bucket, clean, hours, all_uploads):
+    """列出或清理未完成的断点续传记录和云上未完成的分段上传"""
+    if bucket is None:
+        bucket = get_default_bucket()
+        if bucket is None:
+            logger.error('未指定bucket且配置文件中没有默认bucket')
+            sys.exit(1)
+        logger.info(f'使用默认bucket: {bucket}')
+
+    s3 = client()
+    dbpath = get_dbpath()
+    with db_sql(dbpath) as tbj:
+        tbj.crt_tb_transfer_sql()
+
+        if not clean:
+            print('传输日志:')
+            print(tbj.list_transfers(bucket=bucket).to_string(index=False))
+            print()
+            print(f'{bucket} 中未完成的分段上传:')
+            print("cloudpath\tupload_id\tinitiated")
+            for upload in list_multipart_uploads(s3, bucket):
+                print(f"{upload['Key']}\t{upload['UploadId']}\t{upload['Initiated']}")
+            return
+
+        stale = tbj.list_transfers(hours=hours, bucket=bucket)
+        for _, row in stale.iterrows():
+            if row['direction'] == 'upload':
+                abort_multipart_upload(s3, row['bucket'], row['cloudpath'], row['upload_id'])
+            else:
+                partial = row['localpath'] + PARTIAL_SUFFIX
+                if os.path.exists(partial):
+                    os.remove(partial)
+                    logger.info(f'已删除未完成的下载文件: {partial}')
+            tbj.delete_transfer(int(row['id']))
+
+        # 云上不在传输日志中的过期分段上传（例如其他用户或工具遗留），需显式指定才中止
+        aborted = 0
+        if all_uploads:
+            active = set(tbj.list_transfers()['upload_id'].dropna())
+            cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=hours)
+            for upload in list_multipart_uploads(s3, bucket):
+                if upload['UploadId'] not in active and upload['Initiated'] < cutoff:
+                    abort_multipart_upload(s3, bucket, upload['Key'], upload['UploadId'])
+                    aborted += 1
+
+    print(f'已清理 {len(stale)} 条过期传输记录，中止 {aborted} 个不在传输日志中的过期分段上传')
+
+
 @main.command(name="check", short_help="check if a filepath in the middlefile.db")
 @click.option('--filepath', '-f', help='local file path')
 def checkfile(filepath):
     """检查文件是否在数据库中"""
-    dbpath = get_dbpath()
+    dbpath = get_read_dbpath()
     with db_sql(dbpath) as tbj:
         df = tbj.check_file_sql(filepath)
     print(df)
@@ -227,7 +290,7 @@ def queryfile(outfile, subprojectid, product, sample, ftype, fileformat, filepat
         print('所有参数不能为空，请至少提供一个查询条件')
         sys.exit(1)
 
-    dbpath = get_dbpath()
+    dbpath = get_read_dbpath()
     with db_sql(dbpath) as tbj:
         df = tbj.query_recored(notnone_para)
     
@@ -254,7 +317,7 @@ def ref_query(outfile, subprojectid):
         print('子项目ID不能为空')
         sys.exit(1)
     
-    dbpath = get_dbpath()
+    dbpath = get_read_dbpath()
     with db_sql(dbpath) as tbj:
         query_sql = "SELECT * FROM ref WHERE pmid = ?"
         ref_df = pd.read_sql(query_sql, con=tbj.conn, params=(subprojectid,))
@@ -280,7 +343,7 @@ def info():
     print(f"配置文件位置: {config_path}")
     print()
     
-    dbpath = get_dbpath()
+    dbpath = get_read_dbpath()
     with db_sql(dbpath) as tbj:
         df = tbj.get_unique_values()
     
@@ -1,13 +1,35 @@
 """云存储操作模块"""
+import base64
 import datetime
+import hashlib
+import binascii
 import os
+import re
+import sqlite3
 import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from boto3.session import Session
 from botocore.exceptions import ClientError, BotoCoreError
 from .config import get_cloud_config
+from .db import db_sql
 
 logger = logging.getLogger(__name__)
 
+# 分段传输: 大于 PART_SIZE 的文件按分段上传/下载，并在传输日志中记录已完成的分段
+PART_SIZE = 64 * 1024 * 1024
+# S3 协议单次分段上传最多 10000 个分段
+MAX_PARTS = 10000
+# 下载未完成时的临时文件后缀
+PARTIAL_SUFFIX = '.midfile-part'
+# 并发传输的分段数，与 boto3 TransferConfig 默认的 max_concurrency 相同
+MAX_CONCURRENCY = 10
+# 读写文件的块大小
+CHUNK_SIZE = 8 * 1024 * 1024
+# 单次上传对象的 ETag 格式: <文件 md5>
+MD5_ETAG = re.compile(r'^[0-9a-f]{32}$')
+# 分段上传对象的 ETag 格式: <各分段 md5 拼接后的 md5>-<分段数>
+MULTIPART_ETAG = re.compile(r'^[0-9a-f]{32}-(\d+)$')
+
 
 def client():
     """创建云存储客户端"""
@@ -38,39 +60,392 @@ def get_default_bucket():
         return None
 
 
-def upload_file2cloud(s3, bucket, localpath, cloudpath):
-    """上传文件到cloud"""
+def get_part_size(size):
+    """根据文件大小计算分段大小，保证分段数不超过 MAX_PARTS"""
+    return max(PART_SIZE, -(-size // MAX_PARTS))
+
+
+def _iter_parts(size, partsize):
+    """按分段大小切分字节范围，返回 (part_number, start, end)，end 包含在内"""
+    for part_number, start in enumerate(range(0, size, partsize), start=1):
+        yield part_number, start, min(start + partsize, size) - 1
+
+
+def _multipart_etag(part_md5s):
+    """按 S3 规则由各分段的 md5 计算分段上传对象的 ETag"""
+    digests = b''.join(binascii.unhexlify(md5.strip('"')) for md5 in part_md5s)
+    return f'{hashlib.md5(digests).hexdigest()}-{len(part_md5s)}'
+
+
+def _file_md5(filename, start=0, length=None):
+    """计算文件（或文件中一段字节）的 md5"""
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            md5.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return md5.hexdigest()
+
+
+def _transfer_parts(func, parts, on_done):
+    """用线程池并发传输分段，并在调用线程中依次回调 on_done(part_number, start, end, result)
+
+    传输日志使用的 sqlite 连接不是线程安全的，因此只在回调中写日志。
+    同时提交的分段不超过 MAX_CONCURRENCY 个，中断（包括 KeyboardInterrupt）时只等待正在传输的分段。
+    某个分段失败时不再提交新的分段，已完成的分段仍会回调，最后抛出第一个异常。
+    """
+    error = None
+    pending = {}
+    parts = iter(parts)
+    executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+    try:
+        while True:
+            while error is None and len(pending) < MAX_CONCURRENCY:
+                part = next(parts, None)
+                if part is None:
+                    break
+                pending[executor.submit(func, *part)] = part
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                part = pending.pop(future)
+                try:
+                    on_done(*part, future.result())
+                except Exception as e:
+                    if error is None:
+                        error = e
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+    if error is not None:
+        raise error
+
+
+def _verified_parts(filename, journal_parts, parts):
+    """复核传输日志中已完成的分段，只保留本地文件该字节范围的 md5 与日志一致的分段
+    返回 {part_number: (etag, md5)}
+    """
+    verified = {}
+    for part_number, start, end in parts:
+        if part_number not in journal_parts:
+            continue
+        etag, md5 = journal_parts[part_number]
+        if md5 is not None and _file_md5(filename, start, end - start + 1) == md5:
+            verified[part_number] = (etag, md5)
+        else:
+            logger.warning(f'分段 {part_number} 的本地数据与传输日志不一致，重新传输')
+    return verified
+
+
+def _etag_is_md5(head):
+    """判断对象的 ETag 是否由 md5 计算（SSE-KMS 和 SSE-C 加密的对象不是）"""
+    return head.get('ServerSideEncryption') != 'aws:kms' and 'SSECustomerAlgorithm' not in head
+
+
+def _open_journal(dbpath):
+    """打开传输日志，数据库不可用时记录警告并返回 None"""
+    journal = db_sql(dbpath)
+    try:
+        journal.__enter__()
+        journal.crt_tb_transfer_sql()
+    except sqlite3.Error as e:
+        journal.__exit__(None, None, None)
+        logger.warning(f'传输日志不可用，改为不支持断点续传的传输: {e}')
+        return None
+    return journal
+
+
+def _list_uploaded_parts(s3, bucket, key, upload_id):
+    """列出分段上传中已上传的分段，返回 {part_number: etag}；上传已不存在时返回 None"""
+    parts = {}
+    try:
+        paginator = s3.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+            for part in page.get('Parts', []):
+                parts[part['PartNumber']] = part['ETag']
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code', '') == 'NoSuchUpload':
+            return None
+        raise
+    return parts
+
+
+def abort_multipart_upload(s3, bucket, key, upload_id):
+    """中止分段上传，上传已不存在时忽略"""
+    try:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        logger.info(f'已中止分段上传: {bucket}/{key} ({upload_id})')
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code', '') != 'NoSuchUpload':
+            logger.error(f'中止分段上传失败: {e}')
+            raise
+
+
+def list_multipart_uploads(s3, bucket):
+    """列出 bucket 中未完成的分段上传"""
+    uploads = []
     try:
-        s3.upload_file(localpath, bucket, cloudpath)
+        paginator = s3.get_paginator('list_multipart_uploads')
+        for page in paginator.paginate(Bucket=bucket):
+            uploads.extend(page.get('Uploads', []))
+    except (ClientError, BotoCoreError) as e:
+        logger.error(f'查询分段上传失败: {e}')
+        raise
+    return uploads
+
+
+def _resumable_upload(s3, bucket, localpath, cloudpath, journal):
+    """分段上传，已记录在传输日志、云端确认且本地数据未变化的分段不再重复上传"""
+    localpath = os.path.abspath(localpath)
+    size = os.path.getsize(localpath)
+    mtime = os.path.getmtime(localpath)
+    partsize = get_part_size(size)
+    parts = list(_iter_parts(size, partsize))
+
+    done = {}
+    record = journal.get_transfer('upload', bucket, cloudpath, localpath)
+    if record is not None:
+        uploaded = None
+        if (record['size'], record['mtime'], record['partsize']) == (size, mtime, partsize):
+            uploaded = _list_uploaded_parts(s3, bucket, cloudpath, record['upload_id'])
+        else:
+            logger.info(f'本地文件已变化，重新上传: {localpath}')
+            abort_multipart_upload(s3, bucket, cloudpath, record['upload_id'])
+
+        if uploaded is None:
+            journal.delete_transfer(record['id'])
+            record = None
+        else:
+            journal_parts = {n: part for n, part in journal.get_transfer_parts(record['id']).items()
+                             if uploaded.get(n) == part[0]}
+            done = _verified_parts(localpath, journal_parts, parts)
+            logger.info(f'继续上传 {record["upload_id"]}，已完成 {len(done)} 个分段')
+
+    if record is None:
+        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=cloudpath)['UploadId']
+        try:
+            journal.add_transfer('upload', bucket, cloudpath, localpath,
+                                 upload_id, size, mtime, None, partsize)
+        except sqlite3.Error:
+            abort_multipart_upload(s3, bucket, cloudpath, upload_id)
+            raise
+        record = journal.get_transfer('upload', bucket, cloudpath, localpath)
+    transfer_id = record['id']
+    upload_id = record['upload_id']
+
+    def upload_part(part_number, start, end):
+        with open(localpath, 'rb') as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        if len(body) != end - start + 1:
+            raise ValueError(f'分段 {part_number} 读取的字节数 {len(body)} 与预期 {end - start + 1} 不一致')
+        md5 = hashlib.md5(body)
+        # ContentMD5 由云端校验收到的数据，与 ETag 是否为 md5 无关
+        resp = s3.upload_part(Bucket=bucket, Key=cloudpath, UploadId=upload_id,
+                              PartNumber=part_number, Body=body,
+                              ContentMD5=base64.b64encode(md5.digest()).decode('ascii'))
+        return resp['ETag'], md5.hexdigest()
+
+    def on_done(part_number, start, end, result):
+        etag, md5 = result
+        done[part_number] = (etag, md5)
+        journal.add_transfer_part(transfer_id, part_number, etag, md5, start, end)
+        logger.info(f'已上传分段 {part_number}/{len(parts)}')
+
+    _transfer_parts(upload_part, [part for part in parts if part[0] not in done], on_done)
+
+    s3.complete_multipart_upload(
+        Bucket=bucket, Key=cloudpath, UploadId=upload_id,
+        MultipartUpload={'Parts': [{'ETag': done[n][0], 'PartNumber': n} for n, _, _ in parts]})
+
+    head = s3.head_object(Bucket=bucket, Key=cloudpath)
+    error = None
+    if head['ContentLength'] != size:
+        error = f'上传校验失败: 云端大小 {head["ContentLength"]} 与本地大小 {size} 不一致'
+    else:
+        # 预期 ETag 由本地数据的 md5 计算
+        expected_etag = _multipart_etag([done[n][1] for n, _, _ in parts])
+        actual_etag = head['ETag'].strip('"')
+        if actual_etag != expected_etag:
+            message = f'云端 ETag {actual_etag} 与本地数据计算的 {expected_etag} 不一致'
+            # SSE-KMS 或部分兼容 S3 的存储不使用 md5 计算 ETag，此时无法据此判断
+            if MULTIPART_ETAG.match(actual_etag) and _etag_is_md5(head):
+                error = f'上传校验失败: {message}'
+            else:
+                logger.warning(f'{message}，该对象的 ETag 可能不是 md5，跳过 ETag 校验')
+
+    if error is not None:
+        # 删除校验失败的对象，否则重新执行 l2c 时只会提示云上路径已存在
+        s3.delete_object(Bucket=bucket, Key=cloudpath)
+        journal.delete_transfer(transfer_id)
+        raise ValueError(error)
+    journal.delete_transfer(transfer_id)
+
+
+def upload_file2cloud(s3, bucket, localpath, cloudpath, dbpath=None):
+    """上传文件到cloud
+    dbpath: 传输日志所在的数据库，提供时大于 PART_SIZE 的文件按分段上传并支持断点续传；
+    无法打开传输日志时退回普通上传，分段上传开始后的错误直接抛出，重新执行时续传
+    """
+    try:
+        journal = None
+        if dbpath is not None and os.path.getsize(localpath) > PART_SIZE:
+            journal = _open_journal(dbpath)
+        if journal is None:
+            s3.upload_file(localpath, bucket, cloudpath)
+        else:
+            try:
+                _resumable_upload(s3, bucket, localpath, cloudpath, journal)
+            finally:
+                journal.__exit__(None, None, None)
         logger.info(f'{localpath} upload to {bucket}/{cloudpath} finished!')
     except (ClientError, BotoCoreError) as e:
         logger.error(f'上传文件失败: {e}')
         raise
 
 
-def download_file(s3, bucket, key, filename):
-    """从cloud下载文件"""
+def _verify_download(s3, bucket, key, partial, head):
+    """按云端 ETag 校验磁盘上的文件
+    返回 False 表示文件与 ETag 确定不一致；ETag 无法在本地复算时记录警告并返回 True
+    """
+    etag = head['ETag'].strip('"')
+    if not _etag_is_md5(head):
+        logger.warning(f'对象 {key} 使用 SSE-KMS/SSE-C 加密，ETag 不是 md5，跳过 ETag 校验')
+        return True
+    if MD5_ETAG.match(etag):
+        return _file_md5(partial) == etag
+
+    match = MULTIPART_ETAG.match(etag)
+    if match is None:
+        logger.warning(f'无法识别对象 {key} 的 ETag 格式 {etag}，跳过 ETag 校验')
+        return True
+
+    # 分段上传对象的 ETag 依赖上传时的分段大小，由第 1 个和最后 1 个分段的大小确认
+    size = head['ContentLength']
+    nparts = int(match.group(1))
+    try:
+        upload_partsize = s3.head_object(Bucket=bucket, Key=key, PartNumber=1)['ContentLength']
+        last_partsize = s3.head_object(Bucket=bucket, Key=key, PartNumber=nparts)['ContentLength']
+    except ClientError as e:
+        logger.warning(f'无法获取对象 {key} 的上传分段大小，跳过 ETag 校验: {e}')
+        return True
+    ranges = list(_iter_parts(size, upload_partsize))
+    if len(ranges) != nparts or ranges[-1][2] - ranges[-1][1] + 1 != last_partsize:
+        logger.warning(f'对象 {key} 上传时的分段大小不一致，无法复算 ETag，跳过 ETag 校验')
+        return True
+
+    md5s = [_file_md5(partial, start, end - start + 1) for _, start, end in ranges]
+    return _multipart_etag(md5s) == etag
+
+
+def _resumable_download(s3, bucket, key, filename, journal, head):
+    """分段下载到临时文件，已记录在传输日志中且本地数据复核一致的字节范围不再重复下载"""
+    filename = os.path.abspath(filename)
+    size = head['ContentLength']
+    etag = head['ETag']
+    partsize = get_part_size(size)
+    parts = list(_iter_parts(size, partsize))
+    partial = filename + PARTIAL_SUFFIX
+
+    done = {}
+    record = journal.get_transfer('download', bucket, key, filename)
+    if record is not None:
+        if (record['size'], record['etag'], record['partsize']) == (size, etag, partsize) \
+                and os.path.exists(partial) and os.path.getsize(partial) == size:
+            done = _verified_parts(partial, journal.get_transfer_parts(record['id']), parts)
+            logger.info(f'继续下载 {key}，已完成 {len(done)} 个分段')
+        else:
+            logger.info(f'云上文件已变化或临时文件不完整，重新下载: {key}')
+            journal.delete_transfer(record['id'])
+            record = None
+
+    if record is None:
+        with open(partial, 'wb') as f:
+            f.truncate(size)
+        journal.add_transfer('download', bucket, key, filename, None, size, None, etag, partsize)
+        record = journal.get_transfer('download', bucket, key, filename)
+    transfer_id = record['id']
+
+    def download_part(part_number, start, end):
+        # IfMatch 保证各分段来自同一版本的对象
+        resp = s3.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end}', IfMatch=etag)
+        md5 = hashlib.md5()
+        written = 0
+        with open(partial, 'r+b') as f:
+            f.seek(start)
+            for chunk in resp['Body'].iter_chunks(CHUNK_SIZE):
+                f.write(chunk)
+                md5.update(chunk)
+                written += len(chunk)
+            # 写入传输日志前落盘，避免节点宕机后日志记录的分段实际未写入
+            f.flush()
+            os.fsync(f.fileno())
+        if written != end - start + 1:
+            raise ValueError(f'分段 {part_number} 写入的字节数 {written} 与预期 {end - start + 1} 不一致')
+        return md5.hexdigest()
+
+    def on_done(part_number, start, end, md5):
+        journal.add_transfer_part(transfer_id, part_number, None, md5, start, end)
+        logger.info(f'已下载分段 {part_number}/{len(parts)}')
+
+    _transfer_parts(download_part, [part for part in parts if part[0] not in done], on_done)
+
+    if not _verify_download(s3, bucket, key, partial, head):
+        # 清除传输日志和临时文件，重新执行时从头下载
+        journal.delete_transfer(transfer_id)
+        os.remove(partial)
+        raise ValueError(f'下载校验失败: 本地文件与云端 ETag {etag} 不一致')
+
+    os.replace(partial, filename)
+    journal.delete_transfer(transfer_id)
+
+
+def download_file(s3, bucket, key, filename, dbpath=None):
+    """从cloud下载文件
+    dbpath: 传输日志所在的数据库，提供时大于 PART_SIZE 的文件按分段下载并支持断点续传；
+    无法打开传输日志时退回普通下载，分段下载开始后的错误直接抛出，重新执行时续传
+    """
     start_time = datetime.datetime.now()
     logger.info(f'download start: {start_time}') 
 
+    # 确保输出目录存在
     try:
-        # 确保输出目录存在
         outdir = os.path.dirname(filename)
         if outdir and not os.path.exists(outdir):
             os.makedirs(outdir, exist_ok=True)
-        
-        s3.download_file(
-            Bucket=bucket,
-            Key=key,
-            Filename=filename)
+    except OSError as e:
+        logger.error(f'创建输出目录失败: {e}')
+        raise
+
+    try:
+        journal = None
+        head = s3.head_object(Bucket=bucket, Key=key) if dbpath is not None else None
+        if head is not None and head['ContentLength'] > PART_SIZE:
+            journal = _open_journal(dbpath)
+        if journal is None:
+            s3.download_file(
+                Bucket=bucket,
+                Key=key,
+                Filename=filename)
+        else:
+            try:
+                _resumable_download(s3, bucket, key, filename, journal, head)
+            finally:
+                journal.__exit__(None, None, None)
         end_time = datetime.datetime.now()
         logger.info(f'download finished: {end_time}')
     except (ClientError, BotoCoreError) as e:
         logger.error(f'下载文件失败: {e}')
         raise
-    except OSError as e:
-        logger.error(f'创建输出目录失败: {e}')
-        raise 
 
 
 def query_obj(s3, bucket_id, filename):
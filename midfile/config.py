@@ -68,3 +68,16 @@ def get_cloud_config():
         raise ValueError('配置文件中缺少 cloud 配置')
     return config['cloud']
 
+
+
+def get_replica_config():
+    """获取只读副本配置，未配置时返回关闭状态的默认值
+    localdir 默认按用户区分，避免其他用户替换或修改副本
+    """
+    config = load_config()
+    replica = config.get('replica') or {}
+    return {
+        'enabled': bool(replica.get('enabled', False)),
+        'localdir': replica.get('localdir') or f'/tmp/midfile_replica-{os.getuid()}',
+        'max_staleness': int(replica.get('max_staleness', 60)),
+    }
@@ -2,6 +2,7 @@
 import sqlite3
 import logging
 import pandas as pd
+from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
@@ -15,14 +16,55 @@ class db_sql:
     # 允许查询的列名白名单
     ALLOWED_QUERY_COLUMNS = {'pmid', 'product', 'sample', 'ftype', 'fileformat', 'filepath', 'cloudpath', 'downpath'}
     
-    def __init__(self, dbpath):
+    # 写入序号表: 每次写操作递增 seq, 只读副本据此判断是否需要刷新
+    CRT_TB_SQL_WRITE_SEQ = """
+        CREATE TABLE IF NOT EXISTS write_seq(
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        seq INTEGER NOT NULL
+        );"""
+    
+    # 传输日志表: 记录未完成的分段上传/下载, 用于断点续传
+    CRT_TB_SQL_TRANSFERS = """
+        CREATE TABLE IF NOT EXISTS transfers(
+        id INTEGER PRIMARY KEY AUTOINCREMENT UNIQUE NOT NULL,
+        direction TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        cloudpath TEXT NOT NULL,
+        localpath TEXT NOT NULL,
+        upload_id TEXT,
+        size INTEGER,
+        mtime REAL,
+        etag TEXT,
+        partsize INTEGER,
+        created TEXT DEFAULT CURRENT_TIMESTAMP,
+        updated TEXT DEFAULT CURRENT_TIMESTAMP
+        );"""
+    
+    CRT_TB_SQL_TRANSFER_PARTS = """
+        CREATE TABLE IF NOT EXISTS transfer_parts(
+        transfer_id INTEGER NOT NULL,
+        part_number INTEGER NOT NULL,
+        etag TEXT,
+        md5 TEXT,
+        start_byte INTEGER,
+        end_byte INTEGER,
+        PRIMARY KEY (transfer_id, part_number)
+        );"""
+    
+    def __init__(self, dbpath, readonly=False):
         self.dbpath = dbpath
+        self.readonly = readonly
         self.conn = None
         self.cur = None
     
     def __enter__(self):
         """上下文管理器入口"""
-        self.conn = sqlite3.connect(self.dbpath)
+        if self.readonly:
+            # as_uri 会转义路径中的 #、?、% 等字符
+            uri = Path(self.dbpath).resolve().as_uri() + '?mode=ro'
+            self.conn = sqlite3.connect(uri, uri=True)
+        else:
+            self.conn = sqlite3.connect(self.dbpath)
         self.cur = self.conn.cursor()
         return self
     
@@ -64,6 +106,23 @@ class db_sql:
             self.conn.rollback()
             raise
 
+    def _bump_write_seq(self):
+        """递增写入序号，供只读副本判断本地副本是否过期
+        需在写操作的同一事务内、commit 之前调用
+        """
+        self.cur.execute(self.CRT_TB_SQL_WRITE_SEQ)
+        self.cur.execute("INSERT OR IGNORE INTO write_seq (id, seq) VALUES (1, 0)")
+        self.cur.execute("UPDATE write_seq SET seq = seq + 1 WHERE id = 1")
+
+    def get_write_seq(self):
+        """获取当前写入序号，旧数据库没有 write_seq 表时返回 None"""
+        try:
+            self.cur.execute("SELECT seq FROM write_seq WHERE id = 1")
+            row = self.cur.fetchone()
+            return row[0] if row else 0
+        except sqlite3.OperationalError:
+            return None
+
     def crt_tb_sql(self):
         """创建数据库表
         files表:
@@ -79,6 +138,11 @@ class db_sql:
         - pmid: subproject id
         - alignref: 分析时信息搜集表中填写的比对参考基因组版本
         - annoref: 分析时信息搜集表中填写的注释参考基因组版本
+        
+        write_seq表:
+        - seq: 写入序号, 每次 insert/update 递增, 用于只读副本的过期判断
+        
+        transfers/transfer_parts表: 见 crt_tb_transfer_sql
         """
         crt_tb_sql_c = """
         CREATE TABLE IF NOT EXISTS files(
@@ -104,6 +168,10 @@ class db_sql:
         try:
             self.cur.execute(crt_tb_sql_c)
             self.cur.execute(crt_tb_sql_ref)
+            self.cur.execute(self.CRT_TB_SQL_WRITE_SEQ)
+            self.cur.execute("INSERT OR IGNORE INTO write_seq (id, seq) VALUES (1, 0)")
+            self.cur.execute(self.CRT_TB_SQL_TRANSFERS)
+            self.cur.execute(self.CRT_TB_SQL_TRANSFER_PARTS)
             # 升级现有数据库（如果表已存在，添加新列）
             self._upgrade_database()
             self.conn.commit()
@@ -113,6 +181,122 @@ class db_sql:
             self.conn.rollback()
             raise
 
+    def crt_tb_transfer_sql(self):
+        """创建传输日志表（旧数据库未通过 init 升级时也可直接调用）
+        transfers表:
+        - direction: upload 或 download
+        - bucket/cloudpath/localpath: 传输的对象和本地文件（绝对路径）, 三者加 direction 确定一次传输
+        - upload_id: 分段上传的 UploadId, 下载为空
+        - size/mtime: 上传时本地文件的大小和修改时间, 下载时对象的大小; 变化后从头开始
+        - etag: 下载时对象的 ETag, 对象变化后从头开始
+        - partsize: 分段大小
+        
+        transfer_parts表:
+        - part_number: 分段编号, 从 1 开始
+        - etag: 上传分段的 ETag, 下载为空
+        - md5: 本地文件中该分段的 md5, 续传时据此复核本地数据
+        - start_byte/end_byte: 分段的字节范围（包含两端）
+        
+        传输日志不影响 files/ref 表的查询结果, 因此写入时不递增 write_seq
+        """
+        try:
+            self.cur.execute(self.CRT_TB_SQL_TRANSFERS)
+            self.cur.execute(self.CRT_TB_SQL_TRANSFER_PARTS)
+            if not self._check_column_exists('transfer_parts', 'md5'):
+                self.cur.execute("ALTER TABLE transfer_parts ADD COLUMN md5 TEXT")
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f'创建传输日志表失败: {e}')
+            self.conn.rollback()
+            raise
+
+    def get_transfer(self, direction, bucket, cloudpath, localpath):
+        """获取未完成的传输记录，不存在时返回 None"""
+        query_sql = """
+        SELECT id, upload_id, size, mtime, etag, partsize FROM transfers
+        WHERE direction = ? AND bucket = ? AND cloudpath = ? AND localpath = ?
+        ORDER BY id DESC LIMIT 1
+        """
+        self.cur.execute(query_sql, (direction, bucket, cloudpath, localpath))
+        row = self.cur.fetchone()
+        if row is None:
+            return None
+        keys = ('id', 'upload_id', 'size', 'mtime', 'etag', 'partsize')
+        return dict(zip(keys, row))
+
+    def add_transfer(self, direction, bucket, cloudpath, localpath, upload_id, size, mtime, etag, partsize):
+        """新增传输记录，返回记录 id"""
+        insert_sql = """
+        INSERT INTO transfers (direction, bucket, cloudpath, localpath, upload_id, size, mtime, etag, partsize)
+        VALUES (?,?,?,?,?,?,?,?,?)
+        """
+        try:
+            self.cur.execute(insert_sql, (direction, bucket, cloudpath, localpath, upload_id, size, mtime, etag, partsize))
+            self.conn.commit()
+            return self.cur.lastrowid
+        except sqlite3.Error as e:
+            logger.error(f'插入传输记录失败: {e}')
+            self.conn.rollback()
+            raise
+
+    def get_transfer_parts(self, transfer_id):
+        """获取已完成的分段，返回 {part_number: (etag, md5)}"""
+        self.cur.execute("SELECT part_number, etag, md5 FROM transfer_parts WHERE transfer_id = ?", (transfer_id,))
+        return {part_number: (etag, md5) for part_number, etag, md5 in self.cur.fetchall()}
+
+    def add_transfer_part(self, transfer_id, part_number, etag, md5, start, end):
+        """记录一个已完成的分段"""
+        insert_sql = """
+        INSERT OR REPLACE INTO transfer_parts (transfer_id, part_number, etag, md5, start_byte, end_byte)
+        VALUES (?,?,?,?,?,?)
+        """
+        try:
+            self.cur.execute(insert_sql, (transfer_id, part_number, etag, md5, start, end))
+            self.cur.execute("UPDATE transfers SET updated = CURRENT_TIMESTAMP WHERE id = ?", (transfer_id,))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f'记录传输分段失败: {e}')
+            self.conn.rollback()
+            raise
+
+    def delete_transfer(self, transfer_id):
+        """删除传输记录及其分段"""
+        try:
+            self.cur.execute("DELETE FROM transfer_parts WHERE transfer_id = ?", (transfer_id,))
+            self.cur.execute("DELETE FROM transfers WHERE id = ?", (transfer_id,))
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f'删除传输记录失败: {e}')
+            self.conn.rollback()
+            raise
+
+    def list_transfers(self, hours=None, bucket=None):
+        """列出传输记录及已完成的分段数
+        hours: 只列出超过该小时数未更新的记录
+        bucket: 只列出该 bucket 的记录
+        """
+        query_sql = """
+        SELECT t.id, t.direction, t.bucket, t.cloudpath, t.localpath, t.upload_id,
+               t.size, t.partsize, COUNT(p.part_number) AS parts_done, t.created, t.updated
+        FROM transfers t LEFT JOIN transfer_parts p ON p.transfer_id = t.id
+        """
+        where_clauses = []
+        params = []
+        if hours is not None:
+            where_clauses.append("t.updated < datetime('now', ?)")
+            params.append(f'-{hours} hours')
+        if bucket is not None:
+            where_clauses.append("t.bucket = ?")
+            params.append(bucket)
+        if where_clauses:
+            query_sql += f" WHERE {' AND '.join(where_clauses)}"
+        query_sql += " GROUP BY t.id ORDER BY t.id"
+        try:
+            return pd.read_sql(query_sql, con=self.conn, params=params)
+        except Exception as e:
+            logger.error(f'查询传输记录失败: {e}')
+            raise
+
     def insert_tb_sql(self, pmid, product, sample, ftype, fileformat, filepath):
         """插入文件记录"""
         # 验证 pmid 不能为空
@@ -122,6 +306,7 @@ class db_sql:
         insert_sql = "INSERT INTO files (pmid, product, sample, ftype, fileformat, filepath) VALUES (?,?,?,?,?,?)"
         try:
             self.cur.execute(insert_sql, (pmid, product, sample, ftype, fileformat, filepath))
+            self._bump_write_seq()
             self.conn.commit()
         except sqlite3.IntegrityError as e:
             logger.warning(f'文件已存在: {filepath}')
@@ -136,6 +321,7 @@ class db_sql:
         insert_sql = "INSERT INTO ref (pmid, alignref, annoref) VALUES (?,?,?)"
         try:
             self.cur.execute(insert_sql, (pmid, alignref, annoref))
+            self._bump_write_seq()
             self.conn.commit()
         except sqlite3.Error as e:
             logger.error(f'插入参考基因组记录失败: {e}')
@@ -154,6 +340,8 @@ class db_sql:
             self.cur.execute(update_sql, (value, filepath))
             if self.cur.rowcount == 0:
                 logger.warning(f'未找到要更新的文件: {filepath}')
+            else:
+                self._bump_write_seq()
             self.conn.commit()
         except sqlite3.Error as e:
             logger.error(f'更新记录失败: {e}')
@@ -0,0 +1,85 @@
+"""只读副本模块
+
+主数据库位于共享存储（如 NFS）上时，计算节点的只读查询会通过网络读取数据页，
+并与写操作争用锁。开启只读副本后，每个节点在本地目录保存一份数据库副本：
+- 副本的修改时间在 max_staleness 秒以内时直接读取副本，不访问主库
+- 超过该时间后，只读取主库的写入序号（write_seq 表），与副本中的序号一致则仅刷新修改时间
+- 序号不一致时，通过 sqlite backup 接口生成一致性快照，再原子替换本地副本
+写操作始终直接写入主库。副本不可用时自动回退到主库。
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+from .config import get_dbpath, get_replica_config
+from .db import db_sql
+
+logger = logging.getLogger(__name__)
+
+
+def get_replica_path(dbpath, localdir):
+    """获取主库对应的本地副本路径（按主库路径区分，避免多个数据库互相覆盖）"""
+    digest = hashlib.md5(os.path.abspath(dbpath).encode('utf-8')).hexdigest()[:8]
+    return Path(localdir) / f'{Path(dbpath).stem}-{digest}.db'
+
+
+def _read_write_seq(dbpath):
+    """以只读方式读取数据库的写入序号"""
+    with db_sql(dbpath, readonly=True) as tbj:
+        return tbj.get_write_seq()
+
+
+def refresh_replica(dbpath, replica_path):
+    """从主库生成快照并原子替换本地副本"""
+    replica_path.parent.mkdir(parents=True, exist_ok=True)
+    # 副本目录必须属于当前用户，否则其他用户可以替换副本内容
+    if replica_path.parent.stat().st_uid != os.getuid():
+        raise PermissionError(f'本地副本目录不属于当前用户: {replica_path.parent}')
+
+    fd, tmppath = tempfile.mkstemp(prefix=f'.{replica_path.name}.', dir=replica_path.parent)
+    os.close(fd)
+    try:
+        dst = sqlite3.connect(tmppath)
+        try:
+            with db_sql(dbpath, readonly=True) as tbj:
+                tbj.conn.backup(dst)
+        finally:
+            dst.close()
+        os.replace(tmppath, replica_path)
+    except Exception:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+    logger.info(f'已刷新本地只读副本: {replica_path}')
+
+
+def get_read_dbpath():
+    """获取只读命令使用的数据库路径
+
+    未开启只读副本时返回主库路径；开启时返回（必要时刷新后的）本地副本路径。
+    """
+    dbpath = get_dbpath()
+    replica = get_replica_config()
+    if not replica['enabled']:
+        return dbpath
+
+    replica_path = get_replica_path(dbpath, replica['localdir'])
+    try:
+        if replica_path.exists():
+            age = time.time() - replica_path.stat().st_mtime
+            if age <= replica['max_staleness']:
+                return str(replica_path)
+
+            primary_seq = _read_write_seq(dbpath)
+            if primary_seq is not None and primary_seq == _read_write_seq(replica_path):
+                os.utime(replica_path)
+                return str(replica_path)
+
+        refresh_replica(dbpath, replica_path)
+        return str(replica_path)
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f'本地只读副本不可用，改为读取主库: {e}')
+        return dbpath